@@ -1,156 +1,145 @@
+import asyncio
+import functools
+import hashlib
+import itertools
 import json
+import logging
 import os
 import re
-from typing import Any, Dict, List
+import tempfile
+import time
+import uuid
+from pathlib import Path, PurePosixPath
+from typing import (
+    Any,
+    Callable,
+    Collection,
+    Dict,
+    FrozenSet,
+    Iterable,
+    Iterator,
+    List,
+    NamedTuple,
+    Optional,
+    Tuple,
+)
 
+import aiohttp
+import orjson
 import requests
+import tiktoken
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
 
-def post_review_comments(all_reviews: Dict[str, Any]) -> requests.Response:
-    url = f"https://api.github.com/repos/{os.environ['GITHUB_REPOSITORY']}/pulls/{os.environ['PR_NUMBER']}/reviews"
-    headers = {
-        "Authorization": f"token {os.environ['GITHUB_TOKEN']}",
-        "Accept": "application/vnd.github.v3+json",
-    }
-
-    # Create individual review comments for each file
-    comments = []
-    summary_body = "## 🤖 AI-Powered Code Review Summary\n\n"
-
-    for file_name, review in all_reviews.items():
-        file_body = f"### 📄 {file_name} - AI Analysis\n\n"
-        if "error" in review:
-            file_body += f"❌ **Error reviewing {file_name}:** {review['error']}\n\n"
-        else:
-            file_body += f"**🔍 Overall Assessment:** {review['general_assessment']}\n\n"
-
-            file_body += "**👍 Positive Aspects:**\n"
-            for aspect in review["positive_aspects"]:
-                file_body += f"- {aspect}\n"
-            file_body += "\n"
-
-            file_body += "**⚠️ Issues:**\n"
-            for issue in review["issues"]:
-                file_body += f"- **Severity:** {issue['severity']} (Line {issue['line']}): {issue['description']}\n"
-                file_body += f"  **Suggestion:** {issue['suggestion']}\n\n"
-
-            file_body += "**📋 Checklist Violations:**\n"
-            for violation in review["checklist_violations"]:
-                file_body += f"- **Item:** {violation['item']}\n"
-                file_body += f"  **Explanation:** {violation['explanation']}\n"
-                file_body += f"  **Recommendation:** {violation['recommendation']}\n\n"
-
-        comments.append({"path": file_name, "body": file_body.strip(), "position": 1})
-
-        # Add a brief summary to the main review body
-        summary_body += (
-            f"- **{file_name}**: {review.get('general_assessment', 'Review failed')}\n"
-        )
-
-    summary_body += (
-        "\n> Please review the individual file comments for detailed feedback."
-    )
-
-    payload = {
-        "body": summary_body.strip(),
-        "event": "REQUEST_CHANGES",
-        "comments": comments,
-    }
-
-    print(f"💬 Review comments payload: {json.dumps(payload, indent=2)}")
-    response = requests.post(url, headers=headers, json=payload)
-    return response
-
-
-def get_checklist() -> str:
-    def clean_markdown(content: str) -> str:
-        # Remove URLs
-        content = re.sub(
-            r"http[s]?://(?:[a-zA-Z]|[0-9]|[$-_@.&+]|[!*\\(\\),]|(?:%[0-9a-fA-F][0-9a-fA-F]))+",
-            "",
-            content,
-        )
-
-        # Remove emphasis markers, but keep the text
-        content = re.sub(r"([*_~`])(.+?)\1", r"\2", content)
-
-        # Remove heading markers, but keep the text
-        content = re.sub(r"^#+\s+(.+)$", r"\1", content, flags=re.MULTILINE)
+logger = logging.getLogger("llmenstein")
 
-        # Replace multiple newlines with double newline, but preserve table structure
-        lines = content.split("\n")
-        cleaned_lines = []
-        in_table = False
-        for line in lines:
-            if line.strip().startswith("|") and line.strip().endswith("|"):
-                in_table = True
-                cleaned_lines.append(line)
-            elif in_table and line.strip() == "":
-                in_table = False
-                cleaned_lines.append(line)
-            elif not in_table:
-                cleaned_lines.append(line.strip())
-        content = "\n".join(cleaned_lines)
-        content = re.sub(r"\n{3,}", "\n\n", content)
+OLLAMA_MODEL = "llama3.1"
+OLLAMA_CONCURRENCY = int(os.environ.get("OLLAMA_CONCURRENCY", "4"))
+# Responses are streamed, so only a stalled stream is treated as a failure; a
+# long review, or one queued behind others on the server, is left to finish
+OLLAMA_TIMEOUT = aiohttp.ClientTimeout(
+    total=None,
+    sock_connect=30,
+    sock_read=float(os.environ.get("OLLAMA_IDLE_TIMEOUT", "900")),
+)
+GITHUB_GRAPHQL_URL = "https://api.github.com/graphql"
+MAX_DIFF_TOKENS = int(os.environ.get("MAX_DIFF_TOKENS", "3000"))
+DIFF_OVERLAP_TOKENS = 200
+CACHE_DIR = Path(os.environ.get("PR_REVIEW_CACHE_DIR", ".cache"))
+# GitHub rejects review bodies and comments above 65536 characters
+REVIEW_BODY_LIMIT = 60000
+SUMMARY_BODY_LIMIT = 20000
+SUMMARY_ASSESSMENT_LIMIT = 300
+CHECKLIST_CACHE_TTL = int(os.environ.get("CHECKLIST_CACHE_TTL", "3600"))
+RATE_LIMIT_FLOOR = 5
 
-        # Remove any remaining special characters, except those used in tables
-        content = re.sub(r"[^\w\s\.\,\;\:\-\(\)\[\]|]", " ", content)
+# URLs are dropped first, so emphasis can never reach into one; then heading
+# markers are dropped and emphasis markers unwrapped
+_URL_RE = re.compile(
+    r"http[s]?://(?:[a-zA-Z]|[0-9]|[$-_@.&+]|[!*\\(\\),]|(?:%[0-9a-fA-F][0-9a-fA-F]))+"
+)
+_MARKDOWN_RE = re.compile(
+    r"(?P<marker>[*_~`])(?P<text>.+?)(?P=marker)|^#+\s+(?=.)", re.MULTILINE
+)
+_SPECIAL_CHARS_RE = re.compile(r"[^\w\s\.\,\;\:\-\(\)\[\]|]")
 
-        # Normalize whitespace within lines, but preserve newlines
-        content = "\n".join(" ".join(line.split()) for line in content.split("\n"))
-
-        return content.strip()
-
-    def parse_response(response: Dict[str, Any]) -> List[str]:
-        parsed_data = []
-
-        def extract_info(item: Dict[str, Any]):
-            data = clean_markdown(item.get("content"))
-
-            if data:
-                parsed_data.append(data)
-            if "pages" in item and isinstance(item["pages"], list):
-                for page in item["pages"]:
-                    extract_info(page)
-
-        if isinstance(response, dict):
-            extract_info(response)
-        else:
-            raise ValueError("⚠️ The response is not a dict.")
-
-        return parsed_data
-
-    def get_clickup_docs(workspace_id: str, doc_id: str, page_id: str) -> str:
-        url = f"https://api.clickup.com/api/v3/workspaces/{workspace_id}/docs/{doc_id}/pages/{page_id}"
-        headers = {"Authorization": os.environ.get("CLICKUP_TOKEN")}
-
-        try:
-            response = requests.get(url, headers=headers)
-            response.raise_for_status()
-            data = response.json()
-            documents = parse_response(data)
-        except requests.exceptions.RequestException as req_err:
-            print(f"❌ Error during request: {req_err}")
-            documents = []
-        except ValueError as val_err:
-            print(f"❌ Error processing response: {val_err}")
-            documents = []
-
-        return "\n\n\n".join(documents)
-
-    checklist_api_url = os.environ.get("CHECKLIST_API_URL", "")
-    workspace, doc_ids = checklist_api_url.split("app.clickup.com")[1].split("/v/dc/")
-    doc_id, page_id = doc_ids.split("/")
-    return get_clickup_docs(workspace, doc_id, page_id)
+_HUNK_RE = re.compile(r"^(?=@@ )", re.MULTILINE)
+_HUNK_HEADER_RE = re.compile(r"@@ -(\d+)(?:,\d+)? \+(\d+)(?:,\d+)? @@(.*)")
+# Oversized diffs are split at hunks first, then at blank lines, then at lines
+_DIFF_SEPARATORS = (
+    _HUNK_RE,
+    re.compile(r"^(?=[ +-]?$)", re.MULTILINE),
+    re.compile(r"^", re.MULTILINE),
+)
+_SKIP_SUFFIXES = (
+    ".lock",
+    ".min.js",
+    ".min.css",
+    ".map",
+    ".svg",
+    ".png",
+    ".jpg",
+    ".jpeg",
+    ".gif",
+    ".ico",
+    ".pdf",
+    ".woff",
+    ".woff2",
+    ".ttf",
+)
+_SKIP_FILE_NAMES = {"package-lock.json", "pnpm-lock.yaml", "go.sum"}
+_VENDOR_DIRS = {"vendor", "node_modules", "third_party"}
+_GENERATED_MARKERS = ("@generated", "DO NOT EDIT")
 
+# Checklist items are paragraphs; an item naming no language applies to all
+_CHECKLIST_ITEM_RE = re.compile(r"\n\s*\n")
+# Only names that cannot be ordinary English words count as tags; items about
+# cross-cutting topics such as SQL or shell commands stay general
+_LANGUAGE_KEYWORDS = {
+    "python": re.compile(r"\b(?:python|django|flask|fastapi|pytest|pep ?8)\b", re.I),
+    "javascript": re.compile(r"\b(?:javascript|js|nodejs|npm|eslint)\b", re.I),
+    "typescript": re.compile(r"\b(?:typescript|tsx|tsconfig|angular)\b", re.I),
+    "go": re.compile(r"\b(?:golang|goroutines?|gofmt)\b", re.I),
+    "java": re.compile(r"\b(?:java|maven|gradle)\b", re.I),
+    "kotlin": re.compile(r"\b(?:kotlin|ktlint)\b", re.I),
+    "ruby": re.compile(r"\b(?:ruby|rspec|rubocop)\b", re.I),
+    "rust": re.compile(r"\b(?:rustc|rustfmt|clippy)\b", re.I),
+    "csharp": re.compile(r"\b(?:csharp|dotnet|asp\.net)\b", re.I),
+    "php": re.compile(r"\b(?:php|laravel|symfony)\b", re.I),
+    "swift": re.compile(r"\b(?:swiftui|xcode)\b", re.I),
+}
+_LANGUAGES_BY_EXT = {
+    ".py": frozenset({"python"}),
+    ".pyi": frozenset({"python"}),
+    ".js": frozenset({"javascript"}),
+    ".jsx": frozenset({"javascript"}),
+    ".mjs": frozenset({"javascript"}),
+    ".ts": frozenset({"typescript", "javascript"}),
+    ".tsx": frozenset({"typescript", "javascript"}),
+    ".go": frozenset({"go"}),
+    ".java": frozenset({"java"}),
+    ".kt": frozenset({"kotlin"}),
+    ".rb": frozenset({"ruby"}),
+    ".rs": frozenset({"rust"}),
+    ".cs": frozenset({"csharp"}),
+    ".php": frozenset({"php"}),
+    ".swift": frozenset({"swift"}),
+}
 
-def call_ollama_api(diff: str, checklist: str, retries: int = 5) -> Dict[str, Any]:
-    url = os.environ.get("OLLAMA_API_URL", "") + "/api/generate"
-    files = parse_diff(diff)
-    all_reviews = {}
+# Fields the prompt asks for; a review missing one is not cached
+_REVIEW_FIELDS = {
+    "general_assessment": str,
+    "positive_aspects": list,
+    "issues": list,
+    "checklist_violations": list,
+}
 
-    for file_name, file_diff in files.items():
-        prompt = f"""<|begin_of_text|><|start_header_id|>system<|end_header_id|>
+_PROMPT_TEMPLATE = """<|begin_of_text|><|start_header_id|>system<|end_header_id|>
             You are a highly experienced Senior Code Reviewer. Your task is to review a code diff for a single file and provide constructive feedback to help developers improve their skills. Use the following information and instructions:
             
             REVIEW PROCESS:
@@ -228,56 +217,884 @@ def call_ollama_api(diff: str, checklist: str, retries: int = 5) -> Dict[str, An
             <|eot_id|><|start_header_id|>assistant<|end_header_id|>
             """
 
-        payload = {"model": "llama3.1", "prompt": prompt, "stream": False}
+_PR_CONTEXT_QUERY = """
+query($owner: String!, $name: String!, $number: Int!, $cursor: String) {
+  repository(owner: $owner, name: $name) {
+    pullRequest(number: $number) {
+      files(first: 100, after: $cursor) {
+        nodes { path changeType }
+        pageInfo { hasNextPage endCursor }
+      }
+    }
+  }
+}
+"""
 
-        print(f"Processing file review: {file_name}")
-        for attempt in range(retries):
-            try:
-                response = requests.post(url, json=payload)
-                response.raise_for_status()
-                llm_response = response.json().get("response", "")
-                print("Review received: ", llm_response)
-                review = json.loads(llm_response)
-                all_reviews[file_name] = review
+
+class _LazyJson:
+    # Defers serialization until a debug record is actually emitted
+    def __init__(self, value: Any):
+        self.value = value
+
+    def __str__(self) -> str:
+        return orjson.dumps(self.value, option=orjson.OPT_INDENT_2).decode()
+
+
+def _read_cache(path: Path) -> Any:
+    # A missing, unreadable or corrupt entry is treated as a cache miss
+    try:
+        return orjson.loads(path.read_bytes())
+    except (OSError, orjson.JSONDecodeError):
+        return None
+
+
+def _wait_for_rate_limit(response: requests.Response, *args, **kwargs) -> None:
+    # GitHub and ClickUp both report the quota left and its reset epoch
+    remaining = response.headers.get("X-RateLimit-Remaining")
+    reset = response.headers.get("X-RateLimit-Reset")
+    if remaining is None or reset is None or int(remaining) >= RATE_LIMIT_FLOOR:
+        return
+
+    delay = max(0.0, int(reset) - time.time())
+    print(f"⏳ Rate limit almost exhausted, sleeping {delay:.0f}s until reset")
+    time.sleep(delay)
+
+
+SESSION = requests.Session()
+SESSION.mount(
+    "https://",
+    HTTPAdapter(
+        pool_connections=8,
+        pool_maxsize=8,
+        max_retries=Retry(
+            total=5,
+            backoff_factor=1.5,
+            status_forcelist=[429, 500, 502, 503, 504],
+            respect_retry_after_header=True,
+        ),
+    ),
+)
+SESSION.hooks["response"].append(_wait_for_rate_limit)
+
+
+def _truncate(text: str, limit: int, marker: str = "\n\n… (truncated)") -> str:
+    if len(text) <= limit:
+        return text
+    return text[: limit - len(marker)] + marker
+
+
+def _batch_comments(
+    comments: List[Dict[str, Any]], first_budget: int, budget: int
+) -> List[List[Dict[str, Any]]]:
+    # The first review shares its budget with the summary, later ones only
+    # carry a short header
+    batches: List[List[Dict[str, Any]]] = [[]]
+    size = 0
+    for comment in comments:
+        comment["body"] = _truncate(comment["body"], budget)
+
+        length = len(comment["body"])
+        limit = first_budget if len(batches) == 1 else budget
+        # A comment too large to share the first review with the summary
+        # starts the second one, leaving the summary on its own
+        if size + length > limit:
+            batches.append([])
+            size = 0
+        batches[-1].append(comment)
+        size += length
+    return batches
+
+
+def build_review(all_reviews: Dict[str, Any]) -> Tuple[str, List[Dict[str, Any]]]:
+    # Create individual review comments for each file
+    comments = []
+    summary_parts = ["## 🤖 AI-Powered Code Review Summary\n\n"]
+    summary_size = len(summary_parts[0])
+    omitted = 0
+
+    def add_summary_line(line: str) -> None:
+        # Keep the summary bounded; the per-file comments hold the details
+        nonlocal summary_size, omitted
+        if summary_size + len(line) > SUMMARY_BODY_LIMIT:
+            omitted += 1
+            return
+        summary_parts.append(line)
+        summary_size += len(line)
+
+    for file_name, review in all_reviews.items():
+        if "skipped" in review:
+            add_summary_line(f"- **{file_name}**: ⏭️ Skipped ({review['skipped']})\n")
+            continue
+
+        file_parts = [f"### 📄 {file_name} - AI Analysis\n\n"]
+        if "error" in review:
+            file_parts.append(
+                f"❌ **Error reviewing {file_name}:** {review['error']}\n\n"
+            )
+        else:
+            file_parts.append(
+                f"**🔍 Overall Assessment:** {review['general_assessment']}\n\n"
+            )
+
+            file_parts.append("**👍 Positive Aspects:**\n")
+            file_parts.extend(f"- {aspect}\n" for aspect in review["positive_aspects"])
+            file_parts.append("\n")
+
+            file_parts.append("**⚠️ Issues:**\n")
+            for issue in review["issues"]:
+                file_parts.append(
+                    f"- **Severity:** {issue['severity']} (Line {issue['line']}): {issue['description']}\n"
+                    f"  **Suggestion:** {issue['suggestion']}\n\n"
+                )
+
+            file_parts.append("**📋 Checklist Violations:**\n")
+            for violation in review["checklist_violations"]:
+                file_parts.append(
+                    f"- **Item:** {violation['item']}\n"
+                    f"  **Explanation:** {violation['explanation']}\n"
+                    f"  **Recommendation:** {violation['recommendation']}\n\n"
+                )
+
+        file_body = "".join(file_parts)
+        comments.append({"path": file_name, "body": file_body.strip(), "position": 1})
+
+        # Add a brief summary to the main review body
+        assessment = _truncate(
+            str(review.get("general_assessment") or "Review failed"),
+            SUMMARY_ASSESSMENT_LIMIT,
+            "…",
+        )
+        add_summary_line(f"- **{file_name}**: {assessment}\n")
+
+    if omitted:
+        summary_parts.append(f"- … and {omitted} more files\n")
+    summary_parts.append(
+        "\n> Please review the individual file comments for detailed feedback."
+    )
+    return "".join(summary_parts), comments
+
+
+def write_action_outputs(
+    all_reviews: Dict[str, Any], summary_body: str, comments: List[Dict[str, Any]]
+) -> None:
+    # Hand the review to later workflow steps without them re-parsing the log
+    output_path = os.environ.get("GITHUB_OUTPUT")
+    if output_path:
+        delimiter = f"ghadelimiter_{uuid.uuid4()}"
+        with open(output_path, "a", encoding="utf-8") as output:
+            output.write(f"review<<{delimiter}\n")
+            output.write(orjson.dumps(all_reviews).decode())
+            output.write(f"\n{delimiter}\n")
+
+    summary_path = os.environ.get("GITHUB_STEP_SUMMARY")
+    if summary_path:
+        with open(summary_path, "a", encoding="utf-8") as summary:
+            summary.write(summary_body.strip() + "\n\n")
+            summary.write("\n\n".join(comment["body"] for comment in comments))
+            summary.write("\n")
+
+
+def post_review_comments(
+    summary_body: str, comments: List[Dict[str, Any]]
+) -> List[requests.Response]:
+    url = f"https://api.github.com/repos/{os.environ['GITHUB_REPOSITORY']}/pulls/{os.environ['PR_NUMBER']}/reviews"
+    headers = {
+        "Authorization": f"token {os.environ['GITHUB_TOKEN']}",
+        "Accept": "application/vnd.github.v3+json",
+    }
+
+    # Large reviews are split across several reviews to stay under GitHub's
+    # size limit; only the first one carries the summary and requests changes
+    summary_body = summary_body.strip()
+    follow_up_header = "🤖 AI-Powered Code Review ({index}/{total})"
+    batches = _batch_comments(
+        comments,
+        REVIEW_BODY_LIMIT - len(summary_body),
+        REVIEW_BODY_LIMIT - len(follow_up_header) - 16,
+    )
+    responses = []
+    for index, batch in enumerate(batches):
+        if index == 0:
+            payload = {
+                "body": summary_body,
+                "event": "REQUEST_CHANGES",
+                "comments": batch,
+            }
+        else:
+            payload = {
+                "body": follow_up_header.format(index=index + 1, total=len(batches)),
+                "event": "COMMENT",
+                "comments": batch,
+            }
+
+        logger.debug("💬 Review comments payload: %s", _LazyJson(payload))
+        response = SESSION.post(
+            url,
+            headers={**headers, "Content-Type": "application/json"},
+            data=orjson.dumps(payload),
+        )
+        responses.append(response)
+        if not response.ok:
+            # Follow-up reviews would be orphaned without the summary review
+            break
+    return responses
+
+
+def fetch_pr_context(pr_number: int) -> Dict[str, Any]:
+    # One GraphQL round trip per 100 files instead of a REST call per resource
+    owner, name = os.environ["GITHUB_REPOSITORY"].split("/")
+    headers = {"Authorization": f"token {os.environ['GITHUB_TOKEN']}"}
+    variables = {"owner": owner, "name": name, "number": pr_number, "cursor": None}
+    context = {"files": {}}
+
+    try:
+        while True:
+            response = SESSION.post(
+                GITHUB_GRAPHQL_URL,
+                headers=headers,
+                json={"query": _PR_CONTEXT_QUERY, "variables": variables},
+            )
+            response.raise_for_status()
+            data = response.json()
+            if data.get("errors"):
+                raise ValueError(f"⚠️ GraphQL errors: {data['errors']}")
+
+            pull_request = data["data"]["repository"]["pullRequest"]
+            files = pull_request["files"]
+            for node in files["nodes"]:
+                context["files"][node["path"]] = node["changeType"]
+
+            if not files["pageInfo"]["hasNextPage"]:
+                break
+            variables["cursor"] = files["pageInfo"]["endCursor"]
+    except requests.exceptions.RequestException as req_err:
+        print(f"❌ Error during request: {req_err}")
+    except (KeyError, TypeError, ValueError) as val_err:
+        print(f"❌ Error processing PR context: {val_err}")
+
+    return context
+
+
+def _strip_markdown(match: re.Match) -> str:
+    # Emphasized text keeps its inner markers (e.g. __init__)
+    return match.group("text") or ""
+
+
+def clean_markdown(content: str) -> str:
+    content = _MARKDOWN_RE.sub(_strip_markdown, _URL_RE.sub("", content))
+
+    # Single pass over the lines: drop stray lines inside tables, collapse
+    # blank runs, then remove special characters and normalize whitespace.
+    # Blank runs are collapsed before special characters are removed, so a
+    # line of only symbols still counts as text there
+    cleaned_lines = []
+    in_table = False
+    previous_blank = False
+    for line in content.split("\n"):
+        stripped = line.strip()
+        if stripped.startswith("|") and stripped.endswith("|"):
+            in_table = True
+        elif in_table and stripped:
+            continue
+        elif in_table:
+            # The blank line closing a table is kept verbatim
+            in_table = False
+            stripped = line
+
+        if not stripped and previous_blank:
+            continue
+        previous_blank = not stripped
+        cleaned_lines.append(" ".join(_SPECIAL_CHARS_RE.sub(" ", line).split()))
+
+    return "\n".join(cleaned_lines).strip()
+
+
+def get_checklist() -> str:
+    def parse_response(response: Dict[str, Any]) -> List[str]:
+        if not isinstance(response, dict):
+            raise ValueError("⚠️ The response is not a dict.")
+
+        # Depth-first walk over the page tree with an explicit stack; pages are
+        # pushed in reverse so they are visited in document order
+        parsed_data = []
+        stack = [response]
+        while stack:
+            item = stack.pop()
+            data = clean_markdown(item.get("content") or "")
+            if data:
+                parsed_data.append(data)
+
+            pages = item.get("pages")
+            if isinstance(pages, list):
+                stack.extend(reversed(pages))
+
+        return parsed_data
+
+    def get_clickup_docs(workspace_id: str, doc_id: str, page_id: str) -> str:
+        url = f"https://api.clickup.com/api/v3/workspaces/{workspace_id}/docs/{doc_id}/pages/{page_id}"
+        headers = {"Authorization": os.environ.get("CLICKUP_TOKEN")}
+
+        try:
+            response = SESSION.get(url, headers=headers)
+            response.raise_for_status()
+            data = response.json()
+            documents = parse_response(data)
+        except requests.exceptions.RequestException as req_err:
+            print(f"❌ Error during request: {req_err}")
+            documents = []
+        except ValueError as val_err:
+            print(f"❌ Error processing response: {val_err}")
+            documents = []
+
+        return "\n\n\n".join(documents)
+
+    checklist_api_url = os.environ.get("CHECKLIST_API_URL", "")
+    workspace, doc_ids = checklist_api_url.split("app.clickup.com")[1].split("/v/dc/")
+    doc_id, page_id = doc_ids.split("/")
+
+    # The checklist changes on human timescales, so reuse a recent copy
+    cache_key = hashlib.sha256(f"{workspace}:{doc_id}:{page_id}".encode()).hexdigest()
+    cache_file = CACHE_DIR / "checklist" / f"{cache_key[:16]}.json"
+    cached = _read_cache(cache_file)
+    if (
+        isinstance(cached, dict)
+        and isinstance(cached.get("val"), str)
+        and isinstance(cached.get("ts"), (int, float))
+        and cached["ts"] > time.time() - CHECKLIST_CACHE_TTL
+    ):
+        print("♻️ Using the cached checklist")
+        return cached["val"]
+
+    checklist = get_clickup_docs(workspace, doc_id, page_id)
+    if checklist:
+        try:
+            cache_file.parent.mkdir(parents=True, exist_ok=True)
+            cache_file.write_bytes(orjson.dumps({"ts": time.time(), "val": checklist}))
+        except OSError as e:
+            print(f"⚠️ Could not cache the checklist: {e}")
+    return checklist
+
+
+@functools.lru_cache(maxsize=None)
+def _encoding() -> Optional[tiktoken.Encoding]:
+    # The encoding is downloaded on first use; runners that cannot reach the
+    # download host fall back to a length-based estimate
+    try:
+        return tiktoken.get_encoding("cl100k_base")
+    except (requests.RequestException, OSError, ValueError) as e:
+        print(f"⚠️ Could not load the tokenizer, estimating token counts: {e}")
+        return None
+
+
+def _count_tokens(text: str) -> int:
+    encoding = _encoding()
+    if encoding is None:
+        return len(text) // 4
+    return len(encoding.encode(text, disallowed_special=()))
+
+
+class _DiffPiece(NamedTuple):
+    text: str
+    tokens: int
+    hunk: int
+    # Set when the piece starts inside a hunk, i.e. after its @@ header
+    continues: bool = False
+    old_start: int = 0
+    new_start: int = 0
+    old_lines: int = 0
+    new_lines: int = 0
+    context: str = ""
+
+
+def _split_diff(
+    text: str, separators: Tuple[re.Pattern, ...], max_tokens: int
+) -> Iterator[Tuple[str, int]]:
+    separator, *finer = separators
+    for piece in separator.split(text):
+        if not piece:
+            continue
+        tokens = _count_tokens(piece)
+        if tokens > max_tokens and finer:
+            yield from _split_diff(piece, tuple(finer), max_tokens)
+        else:
+            yield piece, tokens
+
+
+def _count_hunk_lines(text: str) -> Tuple[int, int]:
+    old_lines = new_lines = 0
+    for line in text.split("\n"):
+        if line.startswith("-"):
+            old_lines += 1
+        elif line.startswith("+"):
+            new_lines += 1
+        elif line.startswith(" "):
+            old_lines += 1
+            new_lines += 1
+    return old_lines, new_lines
+
+
+def _diff_pieces(body: str, max_tokens: int) -> Iterator[_DiffPiece]:
+    hunks = (hunk for hunk in _HUNK_RE.split(body) if hunk)
+    for index, hunk in enumerate(hunks):
+        tokens = _count_tokens(hunk)
+        if tokens <= max_tokens:
+            yield _DiffPiece(hunk, tokens, index)
+            continue
+
+        header = _HUNK_HEADER_RE.match(hunk)
+        if header is None:
+            for piece, piece_tokens in _split_diff(
+                hunk, _DIFF_SEPARATORS[1:], max_tokens
+            ):
+                yield _DiffPiece(piece, piece_tokens, index)
+            continue
+
+        # Track line numbers through the hunk so that chunks starting in the
+        # middle of it can be given their own @@ header
+        old_line, new_line = int(header[1]), int(header[2])
+        pieces = _split_diff(hunk, _DIFF_SEPARATORS[1:], max_tokens)
+        for position, (piece, piece_tokens) in enumerate(pieces):
+            old_lines, new_lines = _count_hunk_lines(piece)
+            yield _DiffPiece(
+                piece,
+                piece_tokens,
+                index,
+                position > 0,
+                old_line,
+                new_line,
+                old_lines,
+                new_lines,
+                header[3],
+            )
+            old_line += old_lines
+            new_line += new_lines
+
+
+def _render_chunk(header: str, pieces: List[_DiffPiece]) -> str:
+    first = pieces[0]
+    if first.continues:
+        same_hunk = list(itertools.takewhile(lambda p: p.hunk == first.hunk, pieces))
+        old_lines = sum(piece.old_lines for piece in same_hunk)
+        new_lines = sum(piece.new_lines for piece in same_hunk)
+        header += (
+            f"@@ -{first.old_start},{old_lines} +{first.new_start},{new_lines} @@"
+            f"{first.context}\n"
+        )
+    return header + "".join(piece.text for piece in pieces)
+
+
+def chunk_diff(
+    file_diff: str,
+    max_tokens: int = MAX_DIFF_TOKENS,
+    overlap: int = DIFF_OVERLAP_TOKENS,
+) -> List[str]:
+    if _count_tokens(file_diff) <= max_tokens:
+        return [file_diff]
+
+    # Every chunk repeats the file header (index, ---/+++ lines) for context,
+    # and leaves room for a re-emitted hunk header
+    first_hunk = _HUNK_RE.search(file_diff)
+    split_at = first_hunk.start() if first_hunk else 0
+    header, body = file_diff[:split_at], file_diff[split_at:]
+    budget = max(max_tokens - _count_tokens(header) - 32, overlap + 1)
+
+    chunks = []
+    current: List[_DiffPiece] = []
+    current_tokens = 0
+    for piece in _diff_pieces(body, budget):
+        if current and current_tokens + piece.tokens > budget:
+            chunks.append(_render_chunk(header, current))
+
+            # Carry the end of the previous chunk over as leading context
+            tail: List[_DiffPiece] = []
+            tail_tokens = 0
+            for previous in reversed(current):
+                if tail_tokens + previous.tokens > overlap:
+                    break
+                tail.insert(0, previous)
+                tail_tokens += previous.tokens
+            if tail_tokens + piece.tokens > budget:
+                tail, tail_tokens = [], 0
+            current, current_tokens = tail, tail_tokens
+
+        current.append(piece)
+        current_tokens += piece.tokens
+
+    if current:
+        chunks.append(_render_chunk(header, current))
+    return chunks
+
+
+def _is_valid_review(review: Any) -> bool:
+    return isinstance(review, dict) and all(
+        isinstance(review.get(key), kind) for key, kind in _REVIEW_FIELDS.items()
+    )
+
+
+def _review_cache_path(model: str, prompt: str) -> Path:
+    # The key covers the model and the full prompt, so template or checklist
+    # edits invalidate cached reviews on their own
+    key = hashlib.sha256(f"{model}\0{prompt}".encode()).hexdigest()
+    return CACHE_DIR / "reviews" / key[:2] / f"{key}.json"
+
+
+async def _review_chunk(
+    session: aiohttp.ClientSession,
+    url: str,
+    file_name: str,
+    file_diff: str,
+    format_prompt: Callable[..., str],
+    retries: int,
+) -> Dict[str, Any]:
+    prompt = format_prompt(file_name=file_name, file_diff=file_diff)
+
+    cache_file = _review_cache_path(OLLAMA_MODEL, prompt)
+    cached = _read_cache(cache_file)
+    if _is_valid_review(cached):
+        print(f"♻️ Reusing cached review for {file_name}")
+        return cached
+
+    payload = {"model": OLLAMA_MODEL, "prompt": prompt, "stream": True}
+
+    for attempt in range(retries):
+        try:
+            llm_response = await _generate(session, url, payload)
+            logger.debug("Review received for %s: %s", file_name, llm_response)
+            review = orjson.loads(llm_response)
+            # Only well-formed reviews are cached, and a cache that cannot be
+            # written never costs the review itself
+            if _is_valid_review(review):
+                try:
+                    cache_file.parent.mkdir(parents=True, exist_ok=True)
+                    cache_file.write_text(llm_response, encoding="utf-8")
+                except OSError as e:
+                    print(f"⚠️ Could not cache the review for {file_name}: {e}")
+            return review
+        except (
+            aiohttp.ClientError,
+            asyncio.TimeoutError,
+            json.JSONDecodeError,
+        ) as e:
+            print(f"Attempt {attempt + 1} failed for {file_name}: {str(e)}")
+
+    print(f"❌ All retries exhausted for {file_name}")
+    return {"error": f"Failed to get a valid response after {retries} attempts"}
+
+
+class _JsonObjectScanner:
+    # Follows brace depth over streamed text to find where the top-level JSON
+    # object ends, and rejects output that does not start with an object
+    def __init__(self):
+        self.consumed = 0
+        self.depth = 0
+        self.in_string = False
+        self.escaped = False
+
+    def feed(self, text: str) -> Optional[int]:
+        for char in text:
+            self.consumed += 1
+            if self.depth == 0:
+                if char == "{":
+                    self.depth = 1
+                elif not char.isspace():
+                    raise json.JSONDecodeError(
+                        "LLM response is not a JSON object", text, self.consumed - 1
+                    )
+            elif self.in_string:
+                if self.escaped:
+                    self.escaped = False
+                elif char == "\\":
+                    self.escaped = True
+                elif char == '"':
+                    self.in_string = False
+            elif char == '"':
+                self.in_string = True
+            elif char == "{":
+                self.depth += 1
+            elif char == "}":
+                self.depth -= 1
+                if self.depth == 0:
+                    return self.consumed
+        return None
+
+
+async def _generate(
+    session: aiohttp.ClientSession, url: str, payload: Dict[str, Any]
+) -> str:
+    # Read the stream only until the review object is complete; closing the
+    # response early drops the connection, which stops Ollama generating
+    scanner = _JsonObjectScanner()
+    parts = []
+    async with session.post(url, json=payload) as response:
+        response.raise_for_status()
+        async for line in response.content:
+            if not line.strip():
+                continue
+            chunk = orjson.loads(line)
+            if "error" in chunk:
+                raise aiohttp.ClientPayloadError(chunk["error"])
+
+            parts.append(chunk.get("response", ""))
+            end = scanner.feed(parts[-1])
+            if end is not None:
+                response.close()
+                return "".join(parts)[:end]
+            if chunk.get("done"):
                 break
-            except (requests.RequestException, json.JSONDecodeError) as e:
-                print(f"Attempt {attempt + 1} failed for {file_name}: {str(e)}")
-                if attempt == retries - 1:
-                    print(f"❌ All retries exhausted for {file_name}")
-                    all_reviews[file_name] = {
-                        "error": f"Failed to get a valid response after {retries} attempts"
-                    }
 
+    return "".join(parts)
+
+
+def _merge_reviews(reviews: List[Dict[str, Any]]) -> Dict[str, Any]:
+    if len(reviews) == 1:
+        return reviews[0]
+
+    succeeded = [review for review in reviews if "error" not in review]
+    if not succeeded:
+        return reviews[0]
+
+    merged = {
+        "file_name": succeeded[0].get("file_name"),
+        "general_assessment": " ".join(
+            str(review["general_assessment"])
+            for review in succeeded
+            if review.get("general_assessment")
+        ),
+        "positive_aspects": [],
+        "issues": [],
+        "checklist_violations": [],
+    }
+    for review in succeeded:
+        for key in ("positive_aspects", "issues", "checklist_violations"):
+            # The model sometimes answers null or a string for an empty list
+            value = review.get(key)
+            if isinstance(value, list):
+                merged[key].extend(value)
+
+    failed = len(reviews) - len(succeeded)
+    if failed:
+        note = f"{failed} of {len(reviews)} parts of this diff could not be reviewed"
+        merged["general_assessment"] += f" ({note})"
+    return merged
+
+
+def _skip_reason(file_name: str, file_diff: str) -> Optional[str]:
+    path = PurePosixPath(file_name)
+    if file_name.endswith(_SKIP_SUFFIXES) or path.name in _SKIP_FILE_NAMES:
+        return "lockfile or asset"
+    if _VENDOR_DIRS.intersection(path.parts[:-1]):
+        return "vendored code"
+
+    head = file_diff[:4096]
+    if "Binary files " in head or "GIT binary patch" in head:
+        return "binary file"
+    if any(marker in head for marker in _GENERATED_MARKERS):
+        return "generated file"
+
+    hunks = _HUNK_RE.search(file_diff)
+    if hunks is None:
+        return "no content changes"
+    for line in file_diff[hunks.start() :].split("\n"):
+        if line.startswith(("+", "-")) and line[1:].strip():
+            return None
+    return "whitespace-only change"
+
+
+def index_checklist(checklist: str) -> List[Tuple[str, FrozenSet[str]]]:
+    items = []
+    for item in _CHECKLIST_ITEM_RE.split(checklist):
+        item = item.strip()
+        if item:
+            languages = frozenset(
+                language
+                for language, pattern in _LANGUAGE_KEYWORDS.items()
+                if pattern.search(item)
+            )
+            items.append((item, languages))
+    return items
+
+
+def _relevant_checklist(
+    items: List[Tuple[str, FrozenSet[str]]], languages: FrozenSet[str]
+) -> str:
+    return "\n\n".join(
+        item for item, tags in items if not tags or not tags.isdisjoint(languages)
+    )
+
+
+async def call_ollama_api(
+    files: Iterator[Tuple[str, str]],
+    checklist: str,
+    removed_files: Collection[str] = (),
+    retries: int = 5,
+) -> Dict[str, Any]:
+    url = os.environ.get("OLLAMA_API_URL", "") + "/api/generate"
+    checklist_items = index_checklist(checklist)
+    # One prompt formatter per language, with only the checklist items that
+    # are general or mention that language; unknown file types get everything
+    prompt_formatters: Dict[Optional[FrozenSet[str]], Callable[..., str]] = {
+        None: functools.partial(_PROMPT_TEMPLATE.format, checklist=checklist)
+    }
+    all_reviews = {}
+    chunk_reviews: Dict[str, List[Optional[Dict[str, Any]]]] = {}
+    # Bounded, so the diff is only read as fast as the workers consume it and
+    # at most a few files are held in memory at once
+    queue: asyncio.Queue = asyncio.Queue(maxsize=OLLAMA_CONCURRENCY * 2)
+
+    def prepare(file_name: str, file_diff: str) -> List[Tuple[Any, ...]]:
+        if file_name in removed_files:
+            reason = "file removed"
+        else:
+            reason = _skip_reason(file_name, file_diff)
+        if reason:
+            print(f"⏭️ Skipping {file_name}: {reason}")
+            all_reviews[file_name] = {"skipped": reason}
+            return []
+
+        languages = _LANGUAGES_BY_EXT.get(PurePosixPath(file_name).suffix.lower())
+        if languages not in prompt_formatters:
+            prompt_formatters[languages] = functools.partial(
+                _PROMPT_TEMPLATE.format,
+                checklist=_relevant_checklist(checklist_items, languages),
+            )
+        format_prompt = prompt_formatters[languages]
+
+        chunks = chunk_diff(file_diff)
+        if len(chunks) == 1:
+            print(f"Processing file review: {file_name}")
+        else:
+            print(f"Processing file review: {file_name} in {len(chunks)} parts")
+
+        # Reserve the slot so reviews keep the order of the diff
+        all_reviews[file_name] = None
+        chunk_reviews[file_name] = [None] * len(chunks)
+        return [
+            (file_name, index, chunk, format_prompt)
+            for index, chunk in enumerate(chunks)
+        ]
+
+    async def produce() -> None:
+        try:
+            for file_name, file_diff in files:
+                try:
+                    jobs = prepare(file_name, file_diff)
+                except Exception as e:
+                    print(f"❌ Error preparing {file_name}: {e}")
+                    all_reviews[file_name] = {"error": str(e)}
+                    continue
+                for job in jobs:
+                    await queue.put(job)
+        finally:
+            # Always release the workers, so the reviews done so far are kept
+            for _ in range(OLLAMA_CONCURRENCY):
+                await queue.put(None)
+
+    async def review(session: aiohttp.ClientSession) -> None:
+        while (job := await queue.get()) is not None:
+            file_name, index, chunk, format_prompt = job
+            try:
+                result = await _review_chunk(
+                    session, url, file_name, chunk, format_prompt, retries
+                )
+            except Exception as e:
+                # One bad chunk must not cancel the reviews of every other file
+                print(f"❌ Error reviewing {file_name}: {e}")
+                result = {"error": str(e)}
+            chunk_reviews[file_name][index] = result
+
+    async with aiohttp.ClientSession(
+        timeout=OLLAMA_TIMEOUT, json_serialize=lambda obj: orjson.dumps(obj).decode()
+    ) as session:
+        results = await asyncio.gather(
+            produce(),
+            *[review(session) for _ in range(OLLAMA_CONCURRENCY)],
+            return_exceptions=True,
+        )
+    for result in results:
+        if isinstance(result, Exception):
+            print(f"❌ Review stopped early, keeping the finished files: {result}")
+
+    for file_name, reviews in chunk_reviews.items():
+        all_reviews[file_name] = _merge_reviews(
+            [part or {"error": "Not reviewed"} for part in reviews]
+        )
     return all_reviews
 
 
-def parse_diff(diff_text: str) -> Dict[str, str]:
-    files = {}
+def parse_diff(diff_lines: Iterable[str]) -> Iterator[Tuple[str, str]]:
     current_file = None
     current_content = []
 
-    for line in diff_text.split("\n"):
+    for line in diff_lines:
         if line.startswith("diff --git"):
             if current_file:
-                files[current_file] = "\n".join(current_content)
-            current_file = line.split()[-1].lstrip("b/")
+                yield current_file, "\n".join(current_content)
+            current_file = line.rsplit(" ", 1)[1].removeprefix("b/")
             current_content = []
         else:
             current_content.append(line)
 
     if current_file:
-        files[current_file] = "\n".join(current_content)
+        yield current_file, "\n".join(current_content)
 
-    return files
 
+def get_pr_diff(pr_url: str, headers: Dict[str, str]) -> Path:
+    # Conditional GET: a 304 for an unchanged PR does not count against the quota
+    cache_key = hashlib.sha256(pr_url.encode()).hexdigest()[:16]
+    diff_file = CACHE_DIR / f"pr_diff_{cache_key}.diff"
+    etag_file = CACHE_DIR / f"pr_diff_{cache_key}.etag"
 
-def get_pr_diff(pr_url: str, headers: Dict[str, str]) -> str:
-    response = requests.get(pr_url, headers=headers)
+    headers = dict(headers)
+    if diff_file.exists() and etag_file.exists():
+        headers["If-None-Match"] = etag_file.read_text()
+
+    response = SESSION.get(pr_url, headers=headers, stream=True)
+    if response.status_code == 304:
+        response.close()
+        print("♻️ Diff unchanged since the last run, using the cached copy")
+        return diff_file
     response.raise_for_status()
-    return response.text
+
+    # Spool the whole diff to disk before reviewing, so the connection is not
+    # held open while the model runs and a dropped download fails up front
+    partial_file = diff_file.with_suffix(".part")
+    try:
+        CACHE_DIR.mkdir(parents=True, exist_ok=True)
+        spool = partial_file.open("wb")
+    except OSError as e:
+        print(f"⚠️ Could not write to the cache, using a temporary file: {e}")
+        spool = tempfile.NamedTemporaryFile(suffix=".diff", delete=False)
+    with response, spool:
+        for chunk in response.iter_content(chunk_size=64 * 1024):
+            spool.write(chunk)
+    if Path(spool.name) != partial_file:
+        return Path(spool.name)
+
+    # Keeping the copy for the next run is best-effort
+    try:
+        partial_file.replace(diff_file)
+        etag = response.headers.get("ETag")
+        if etag:
+            etag_file.write_text(etag)
+        else:
+            etag_file.unlink(missing_ok=True)
+    except OSError as e:
+        print(f"⚠️ Could not cache the diff: {e}")
+        return partial_file if partial_file.exists() else diff_file
+    return diff_file
+
+
+def read_diff(diff_file: Path) -> Iterator[str]:
+    with diff_file.open(encoding="utf-8", errors="replace", newline="\n") as diff:
+        for line in diff:
+            yield line.removesuffix("\n")
 
 
 def main():
+    logging.basicConfig(format="%(message)s")
+    debug = bool(os.environ.get("PR_REVIEW_DEBUG"))
+    logger.setLevel(logging.DEBUG if debug else logging.INFO)
+
     pr_url = f"https://api.github.com/repos/{os.environ['GITHUB_REPOSITORY']}/pulls/{os.environ['PR_NUMBER']}"
     headers = {
         "Authorization": f"token {os.environ['GITHUB_TOKEN']}",
@@ -285,21 +1102,33 @@ def main():
     }
 
     try:
-        diff = get_pr_diff(pr_url, headers)
-        print("🔍 Diff received:\n" + "-" * 100)
-        print(diff)
-
         checklist = get_checklist()
-        print("📋 Checklist fetched:\n" + "-" * 100)
-        print(checklist)
+        print(f"📋 Checklist fetched: {len(checklist)} characters")
+        logger.debug("%s", checklist)
+
+        context = fetch_pr_context(int(os.environ["PR_NUMBER"]))
+        removed_files = {
+            path
+            for path, change_type in context["files"].items()
+            if change_type == "DELETED"
+        }
+
+        files = parse_diff(read_diff(get_pr_diff(pr_url, headers)))
+        # uvloop is optional; it only makes the Ollama fan-out cheaper
+        run = uvloop.run if uvloop else asyncio.run
+        review = run(call_ollama_api(files, checklist, removed_files))
+        print(f"✅ Reviews received for {len(review)} files")
+        logger.debug("%s", _LazyJson(review))
 
-        review = call_ollama_api(diff, checklist)
-        print("✅ Review received:\n" + "-" * 100)
-        print(json.dumps(review, indent=2))
+        summary_body, comments = build_review(review)
+        write_action_outputs(review, summary_body, comments)
 
-        res = post_review_comments(review)
-        print("📤 GitHub response:\n" + "-" * 100)
-        print(res.json())
+        for res in post_review_comments(summary_body, comments):
+            print(f"📤 GitHub response: {res.status_code}")
+            if res.ok:
+                logger.debug("%s", res.text)
+            else:
+                print(res.text)
 
     except requests.RequestException as e:
         print(f"❌ Error occurred while making a request: {e}")
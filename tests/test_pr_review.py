@@ -0,0 +1,239 @@
+import importlib.util
+import random
+import re
+from pathlib import Path
+
+_SCRIPT = Path(__file__).resolve().parents[1] / ".github" / "workflows" / "pr_review.py"
+_spec = importlib.util.spec_from_file_location("pr_review", _SCRIPT)
+pr_review = importlib.util.module_from_spec(_spec)
+_spec.loader.exec_module(pr_review)
+
+
+def _baseline_clean_markdown(content):
+    # The original multi-pass implementation, kept as the reference
+    content = re.sub(
+        r"http[s]?://(?:[a-zA-Z]|[0-9]|[$-_@.&+]|[!*\\(\\),]|(?:%[0-9a-fA-F][0-9a-fA-F]))+",
+        "",
+        content,
+    )
+    content = re.sub(r"([*_~`])(.+?)\1", r"\2", content)
+    content = re.sub(r"^#+\s+(.+)$", r"\1", content, flags=re.MULTILINE)
+    cleaned_lines = []
+    in_table = False
+    for line in content.split("\n"):
+        if line.strip().startswith("|") and line.strip().endswith("|"):
+            in_table = True
+            cleaned_lines.append(line)
+        elif in_table and line.strip() == "":
+            in_table = False
+            cleaned_lines.append(line)
+        elif not in_table:
+            cleaned_lines.append(line.strip())
+    content = "\n".join(cleaned_lines)
+    content = re.sub(r"\n{3,}", "\n\n", content)
+    content = re.sub(r"[^\w\s\.\,\;\:\-\(\)\[\]|]", " ", content)
+    content = "\n".join(" ".join(line.split()) for line in content.split("\n"))
+    return content.strip()
+
+
+_MARKDOWN_TOKENS = [
+    "my_func",
+    "MAX_RETRIES",
+    "__init__",
+    "https://docs.example.com/api_reference/get_user",
+    "http://x.io/a_b*c",
+    "*bold*",
+    "_italic_",
+    "`code`",
+    "~gone~",
+    "# ",
+    "## Heading",
+    "word",
+    ".",
+    "_",
+    "*",
+    "#",
+    "  ",
+    "\n",
+    "\n\n\n",
+    "\n  \n",
+    "| a | b |",
+]
+
+
+def test_clean_markdown_keeps_identifiers_next_to_urls():
+    assert (
+        pr_review.clean_markdown(
+            "Call my_func and read https://docs.example.com/api_reference/get_user"
+        )
+        == "Call my_func and read"
+    )
+    assert (
+        pr_review.clean_markdown("Set MAX_RETRIES per https://wiki.corp/retry_policy")
+        == "Set MAX_RETRIES per"
+    )
+
+
+def test_clean_markdown_matches_baseline():
+    rng = random.Random(0)
+    for _ in range(3000):
+        content = "".join(
+            rng.choice(_MARKDOWN_TOKENS) + rng.choice(["", " "])
+            for _ in range(rng.randint(1, 15))
+        )
+        assert pr_review.clean_markdown(content) == _baseline_clean_markdown(
+            content
+        ), content
+
+
+GENERAL_ITEMS = [
+    "Avoid SQL injection with parameterized queries.",
+    "Do not shell out with user input.",
+    "React to errors promptly and log them with context.",
+    "Each tree node should be validated.",
+    "Use guard rails around destructive operations.",
+    "Keep the spring of a retry loop bounded with a cargo of backoff.",
+    "Prefer swift failure over silent corruption.",
+]
+
+
+def _checklist_for(file_name, checklist):
+    items = pr_review.index_checklist(checklist)
+    languages = pr_review._LANGUAGES_BY_EXT.get(Path(file_name).suffix.lower())
+    return pr_review._relevant_checklist(items, languages).split("\n\n")
+
+
+def test_ambiguous_words_keep_items_general():
+    checklist = "\n\n".join(GENERAL_ITEMS)
+    for item, tags in pr_review.index_checklist(checklist):
+        assert not tags, item
+    assert _checklist_for("app.py", checklist) == GENERAL_ITEMS
+
+
+def test_language_items_only_reach_matching_files():
+    checklist = "\n\n".join(
+        ["Run pytest before merging.", "Fix every eslint warning."] + GENERAL_ITEMS
+    )
+    assert (
+        _checklist_for("app.py", checklist)
+        == ["Run pytest before merging."] + GENERAL_ITEMS
+    )
+    assert (
+        _checklist_for("app.ts", checklist)
+        == ["Fix every eslint warning."] + GENERAL_ITEMS
+    )
+
+
+def _numbered_diff():
+    # Every line names its own old/new line numbers so chunks can be checked
+    # against the headers they carry; blank context lines exercise splitting
+    # at blank lines inside an oversized hunk
+    hunks = []
+    old_line = new_line = 1
+    for hunk_index, size in enumerate([5, 400, 12]):
+        old_start, new_start = old_line, new_line
+        lines = []
+        for i in range(size):
+            kind = i % 4
+            if kind == 0:
+                lines.append(f"-removed old={old_line}")
+                old_line += 1
+            elif kind == 1:
+                lines.append(f"+added new={new_line}")
+                new_line += 1
+            elif kind == 2 and i % 12 == 2:
+                lines.append(" ")
+                old_line += 1
+                new_line += 1
+            else:
+                lines.append(f" context old={old_line} new={new_line}")
+                old_line += 1
+                new_line += 1
+        old_count = sum(not line.startswith("+") for line in lines)
+        new_count = sum(not line.startswith("-") for line in lines)
+        hunks.append(
+            f"@@ -{old_start},{old_count} +{new_start},{new_count} @@ def f{hunk_index}():\n"
+            + "\n".join(lines)
+            + "\n"
+        )
+        old_line += 10
+        new_line += 10
+    header = "index 1111111..2222222 100644\n--- a/app.py\n+++ b/app.py\n"
+    return header + "".join(hunks)
+
+
+def _estimate_tokens(monkeypatch):
+    monkeypatch.setattr(pr_review, "_encoding", lambda: None)
+
+
+def test_count_tokens_falls_back_without_tokenizer(monkeypatch):
+    def unavailable(name):
+        raise OSError("no network")
+
+    monkeypatch.setattr(pr_review.tiktoken, "get_encoding", unavailable)
+    pr_review._encoding.cache_clear()
+    try:
+        assert pr_review._encoding() is None
+        assert pr_review._count_tokens("x" * 40) == 10
+    finally:
+        pr_review._encoding.cache_clear()
+
+
+def test_chunk_diff_keeps_every_changed_line(monkeypatch):
+    _estimate_tokens(monkeypatch)
+    file_diff = _numbered_diff()
+    chunks = pr_review.chunk_diff(file_diff, max_tokens=300, overlap=40)
+
+    assert len(chunks) > 3
+    chunked_lines = {line for chunk in chunks for line in chunk.split("\n")}
+    for line in file_diff.split("\n"):
+        if line.startswith(("+", "-")):
+            assert line in chunked_lines, line
+    for chunk in chunks:
+        assert chunk.startswith("index 1111111..2222222 100644\n--- a/app.py\n")
+
+
+def test_chunk_diff_continuation_headers_match_their_lines(monkeypatch):
+    _estimate_tokens(monkeypatch)
+    file_diff = _numbered_diff()
+    original_headers = set(re.findall(r"^@@ .*$", file_diff, re.MULTILINE))
+    chunks = pr_review.chunk_diff(file_diff, max_tokens=300, overlap=40)
+
+    continued = 0
+    for chunk in chunks:
+        body = chunk.split("+++ b/app.py\n", 1)[1]
+        for hunk in re.split(r"^(?=@@ )", body, flags=re.MULTILINE):
+            match = pr_review._HUNK_HEADER_RE.match(hunk)
+            if match is None:
+                continue
+            header, *lines = hunk.rstrip("\n").split("\n")
+            old_line, new_line = int(match[1]), int(match[2])
+            old_count = new_count = 0
+            for line in lines:
+                numbers = dict(re.findall(r"(old|new)=(\d+)", line))
+                assert int(numbers.get("old", old_line)) == old_line, line
+                assert int(numbers.get("new", new_line)) == new_line, line
+                if not line.startswith("+"):
+                    old_line += 1
+                    old_count += 1
+                if not line.startswith("-"):
+                    new_line += 1
+                    new_count += 1
+
+            if header not in original_headers:
+                continued += 1
+                counts = re.match(r"@@ -\d+,(\d+) \+\d+,(\d+) @@", header)
+                assert (int(counts[1]), int(counts[2])) == (old_count, new_count)
+                assert header.endswith(" def f1():")
+    assert continued > 0
+
+
+def test_chunk_diff_without_hunks(monkeypatch):
+    _estimate_tokens(monkeypatch)
+    file_diff = "\n".join(f"line {i}" for i in range(2000))
+    chunks = pr_review.chunk_diff(file_diff, max_tokens=300, overlap=40)
+
+    assert len(chunks) > 1
+    assert not any("@@" in chunk for chunk in chunks)
+    chunked_lines = {line for chunk in chunks for line in chunk.split("\n")}
+    assert chunked_lines >= set(file_diff.split("\n"))